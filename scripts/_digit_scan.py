@@ -0,0 +1,49 @@
+"""numba kernel for the detailed summarizer's number/citation prefilter.
+
+Imported lazily by detailed_summarizer._candidate_windows, so numpy/numba and
+the compile only cost anything once a long section actually needs scanning.
+"""
+import numpy as np
+from numba import njit
+
+@njit("boolean(uint8)", cache=True)
+def _is_letter(c):
+    return 65 <= c <= 90 or 97 <= c <= 122
+
+@njit("int64[:, :](uint8[::1], int64)", cache=True)
+def digit_windows(buf, pad):
+    """(start, end) spans around ASCII digit runs, padded and merged.
+
+    Padded edges that land inside a word are pushed out to the word boundary,
+    so an author name or "participants" longer than pad is never cut.
+    """
+    n = buf.shape[0]
+    out = np.empty((n // 2 + 1, 2), dtype=np.int64)
+    k = 0
+    i = 0
+    while i < n:
+        if 48 <= buf[i] <= 57:
+            start = max(i - pad, 0)
+            while start > 0 and _is_letter(buf[start - 1]):
+                start -= 1
+            while i < n and 48 <= buf[i] <= 57:
+                i += 1
+            end = min(i + pad, n)
+            while end < n and _is_letter(buf[end]):
+                end += 1
+            if k > 0 and start <= out[k - 1, 1]:
+                out[k - 1, 1] = end
+            else:
+                out[k, 0] = start
+                out[k, 1] = end
+                k += 1
+        else:
+            i += 1
+    return out[:k]
+
+def text_windows(text: str, pad: int):
+    """(start, end) spans of text worth running the regexes over."""
+    # ascii/replace keeps one byte per character, so offsets index text directly;
+    # the bytearray makes the buffer writable, which the signature requires
+    buf = np.frombuffer(bytearray(text.encode("ascii", "replace")), dtype=np.uint8)
+    return digit_windows(buf, pad)
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 from __future__ import annotations
-import argparse, traceback, time, os, sys
+import argparse, gc, queue, shutil, threading, traceback, time, os, sys
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
 from pathlib import Path
 from typing import Dict, List, Tuple
 import re
@@ -8,12 +12,15 @@ import re
 if __name__ == "__main__" and __package__ is None:
     sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-import torch
 from app.sections import split_into_sections
-from scripts.common import DEFAULT_MODELS, load_model, sanitize
+from scripts.common import (DEFAULT_MODELS, QUANTIZE_MODES, generation_context, load_model, process_pdf,
+                            sanitize, summarize_text_with, to_device)
 from app.pdf_io import extract_text_by_page
 
-DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# Set in main() once torch is imported (deferred so --help and PDF
+# extraction don't pay for it)
+DEVICE = None
+CHARS_PER_TOKEN = 6
 
 # Simpler, more direct prompts
 SECTION_PROMPTS = {
@@ -50,193 +57,408 @@ def clean_summary(text: str, min_words: int = 10) -> str:
         return "not reported"
     return result
 
-def summarize_with_model(tok, model, text: str, max_in: int, max_out: int, beams: int) -> str:
-    """Single-pass summarization with the model."""
+def encode_prompts(tok) -> Dict[str, List[int]]:
+    """Tokenize every section prompt once per model."""
+    return {name: tok(prompt, add_special_tokens=False)["input_ids"] for name, prompt in SECTION_PROMPTS.items()}
+
+def summarize_batch(tok, model, prompt_ids: List[List[int]], texts: List[str], max_in: int, max_out: int,
+                    beams: int, batch_size: int = 4) -> List[str]:
+    """Summarize several inputs with padded model.generate calls.
+
+    Each input is its pre-tokenized prompt followed by the tokenized text.
+    Inputs are grouped by token length so each batch pads to a similar
+    length; results come back in the original order.
+    """
+    if not texts:
+        return []
+    import torch
     # Get safe max length for this model
     safe_max = min(max_in, getattr(model.config, "max_position_embeddings", max_in))
     
-    # Encode with truncation
-    enc = tok(text, return_tensors="pt", truncation=True, max_length=safe_max)
-    enc = {k: v.to(DEVICE) for k, v in enc.items()}
+    # English averages well under 6 chars/token, so anything past this
+    # would be tokenized only to be truncated away
+    char_budget = safe_max * CHARS_PER_TOKEN
+    texts = [t[:char_budget] for t in texts]
+    
+    # Only the bodies are tokenized here; the prompt ids are reused as-is.
+    # The body is truncated so the prompt always survives.
+    room = safe_max - tok.num_special_tokens_to_add()
+    body_ids = tok(texts, add_special_tokens=False)["input_ids"]
+    ids = [tok.build_inputs_with_special_tokens((p + b)[:room]) for p, b in zip(prompt_ids, body_ids)]
+    order = sorted(range(len(ids)), key=lambda i: len(ids[i]))
     
-    with torch.no_grad():
-        out = model.generate(
-            **enc,
-            max_new_tokens=max_out,
-            num_beams=beams,
-            do_sample=False,
-            length_penalty=1.0,
-            early_stopping=True,
-            no_repeat_ngram_size=3,
-            repetition_penalty=1.2,
-        )
+    batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+    copy_stream = torch.cuda.Stream() if DEVICE.type == "cuda" else None
     
-    result = tok.decode(out[0], skip_special_tokens=True, clean_up_tokenization_spaces=True)
-    return result.replace(" <n> ", "\n").replace("<n>", "\n")
+    def stage(batch_idx):
+        enc = tok.pad({"input_ids": [ids[i] for i in batch_idx]}, return_tensors="pt")
+        if copy_stream is None:
+            return to_device(enc, DEVICE)
+        # Side stream so the pinned copy overlaps the running generate
+        with torch.cuda.stream(copy_stream):
+            return to_device(enc, DEVICE)
+    
+    results: List[str] = [""] * len(ids)
+    next_enc = stage(batches[0])
+    for n, batch_idx in enumerate(batches):
+        enc = next_enc
+        if copy_stream is not None:
+            torch.cuda.current_stream().wait_stream(copy_stream)
+            for v in enc.values():
+                v.record_stream(torch.cuda.current_stream())
+        if n + 1 < len(batches):
+            next_enc = stage(batches[n + 1])
+        
+        with generation_context(model):
+            out = model.generate(
+                **enc,
+                max_new_tokens=max_out,
+                num_beams=beams,
+                do_sample=False,
+                length_penalty=1.0,
+                early_stopping=True,
+                no_repeat_ngram_size=3,
+                repetition_penalty=1.2,
+            )
+        
+        decoded = tok.batch_decode(out, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        for i, r in zip(batch_idx, decoded):
+            results[i] = r.replace(" <n> ", "\n").replace("<n>", "\n")
+    return results
+
+class Summarizer(ABC):
+    """One way of turning a PDF into a summary with a loaded model."""
+    name = ""
+
+    @abstractmethod
+    def prepare(self, pdf: Path) -> Tuple[object, List[str]]:
+        """Extract a PDF. Returns (document, log lines); document is None to skip it."""
+
+    @abstractmethod
+    def describe(self, doc) -> str:
+        """Report line describing the prepared document."""
+
+    def begin_model(self, tok) -> None:
+        """Per-model setup, called once after a model is loaded."""
+
+    def end_model(self) -> None:
+        """Drop per-model state before the model is released."""
+
+    @abstractmethod
+    def summarize(self, tok, model, doc, args, log) -> str:
+        """Summarize a prepared document with the loaded model."""
+
+
+class SectionAwareSummarizer(Summarizer):
+    """Summarize each detected section with its own prompt."""
+    name = "section"
+
+    def __init__(self):
+        self.prompt_ids: Dict[str, List[int]] = {}
+
+    def prepare(self, pdf: Path) -> Tuple[object, List[str]]:
+        notes = []
+        raw = extract_text_by_page(str(pdf))
+        notes.append(f"[INFO] Total text length: {len(raw)} characters")
+        
+        # Try to split into sections
+        sections = split_into_sections(raw)
+        
+        # Log what we found
+        notes.append(f"[INFO] Sections detected: {list(sections.keys())}")
+        for name, text in sections.items():
+            notes.append(f"  - {name}: {len(text)} chars")
+        
+        # Only keep sections with substantial content
+        valid_sections = {}
+        for name, text in sections.items():
+            if len(text) > 300:  # Need at least 300 chars for meaningful content
+                valid_sections[name] = text
+            else:
+                notes.append(f"  - Skipping {name} (too short: {len(text)} chars)")
+        
+        if not valid_sections:
+            notes.append(f"[WARN] No valid sections found, skipping PDF")
+            return None, notes
+        
+        notes.append(f"[OK] Using {len(valid_sections)} sections: {list(valid_sections.keys())}\n")
+        return valid_sections, notes
+
+    def describe(self, doc) -> str:
+        return f"_Sections found_: {', '.join(doc.keys())}\n"
+
+    def begin_model(self, tok) -> None:
+        self.prompt_ids = encode_prompts(tok)
+
+    def end_model(self) -> None:
+        self.prompt_ids = {}
+
+    def summarize(self, tok, model, doc, args, log) -> str:
+        """Summarize the known sections of one PDF and return the combined text."""
+        sections = doc
+        parts = []
+        section_order = ["abstract", "introduction", "methods", "results", "discussion", "conclusion"]
+        names = [name for name in section_order if name in sections]
+        
+        for section_name in names:
+            log(f"  [{section_name}] Processing {len(sections[section_name])} chars...")
+        
+        # Sections of this PDF are batched together
+        try:
+            summaries = summarize_batch(
+                tok, model,
+                [self.prompt_ids.get(name, self.prompt_ids["abstract"]) for name in names],
+                [sections[name] for name in names],
+                args.max_in_tokens,
+                args.max_out_tokens,
+                args.num_beams,
+                args.batch_size,
+            )
+        except Exception as e:
+            log(f"  ✗ Error: {e}")
+            summaries = [None] * len(names)
+            parts.extend(f"**{name.title()}**: [Error: {e}]" for name in names)
+        
+        for section_name, summary in zip(names, summaries):
+            if summary is None:
+                continue
+            summary = clean_summary(summary)
+            
+            if summary != "not reported":
+                parts.append(f"**{section_name.title()}**: {summary}")
+                log(f"  [{section_name}] ✓ Generated {len(summary)} chars")
+            else:
+                log(f"  [{section_name}] ⚠ Summary too short or invalid")
+        
+        if not parts:
+            parts.append("**Note**: No valid summaries generated for this model.")
+        
+        return "\n\n".join(parts)
+
+
+class ChunkedStructuredSummarizer(Summarizer):
+    """Stitch the sections together and summarize into one structured abstract."""
+    name = "chunked"
+
+    def prepare(self, pdf: Path) -> Tuple[object, List[str]]:
+        text = process_pdf(pdf)
+        notes = [f"[INFO] Stitched text length: {len(text)} characters\n"]
+        return (text or None), notes
+
+    def describe(self, doc) -> str:
+        return f"_Input_: {len(doc)} chars, stitched\n"
+
+    def summarize(self, tok, model, doc, args, log) -> str:
+        log(f"  Processing {len(doc)} chars...")
+        try:
+            summary = summarize_text_with(
+                tok, model, doc,
+                structured=True,
+                max_in_tokens=args.max_in_tokens,
+                max_out_tokens=args.max_out_tokens,
+                num_beams=args.num_beams,
+                chunk_beams=args.chunk_beams,
+            )
+        except Exception as e:
+            log(f"  ✗ Error: {e}")
+            return f"**Note**: [Error: {e}]"
+        log(f"  ✓ Generated {len(summary)} chars")
+        return summary or "**Note**: No valid summary generated for this model."
+
+
+STRATEGIES = {cls.name: cls for cls in (SectionAwareSummarizer, ChunkedStructuredSummarizer)}
+
+def prepare_pdf(strategy: Summarizer, pdf: Path):
+    """Worker-process entry point. Returns (doc, notes, (message, traceback) or None)."""
+    try:
+        doc, notes = strategy.prepare(pdf)
+        return doc, notes, None
+    except Exception as e:
+        return None, [], (str(e), traceback.format_exc())
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--pdf", nargs="+", required=True)
     ap.add_argument("--models", nargs="+", default=DEFAULT_MODELS)
     ap.add_argument("--outdir", default="out")
+    ap.add_argument("--strategy", choices=sorted(STRATEGIES), default="section",
+                    help="section: one prompt per detected section; chunked: one structured summary of the stitched text")
     ap.add_argument("--max_in_tokens", type=int, default=1024)
     ap.add_argument("--max_out_tokens", type=int, default=256)
     ap.add_argument("--num_beams", type=int, default=4)
+    ap.add_argument("--chunk_beams", type=int, default=1,
+                    help="Beams per chunk in the chunked strategy (1 = greedy); the merge pass keeps beam search")
+    ap.add_argument("--batch_size", type=int, default=4,
+                    help="Sections per generate call (sorted by length before batching)")
+    ap.add_argument("--quantize", choices=QUANTIZE_MODES, default="none",
+                    help="int8 (bitsandbytes) or bf16 weights")
+    ap.add_argument("--compile", action="store_true",
+                    help="Run the model forward pass through torch.compile")
+    ap.add_argument("--bf16_autocast", action="store_true",
+                    help="Run generation under bf16 autocast on GPUs that support it (default: fp32)")
+    ap.add_argument("--jit", action="store_true",
+                    help="Trace the encoder with TorchScript (falls back to eager if tracing fails)")
     args = ap.parse_args()
 
+    global DEVICE
+    strategy = STRATEGIES[args.strategy]()
+
     outdir = Path(args.outdir)
     outdir.mkdir(parents=True, exist_ok=True)
     log_path = outdir / "benchmark.log"
 
+    log_fh = open(log_path, "a", encoding="utf-8", buffering=1)
+
     def log(msg: str):
         print(msg, flush=True)
-        with open(log_path, "a", encoding="utf-8") as f:
-            f.write(msg + "\n")
-
-    log(f"\n{'='*60}")
-    log(f"[INFO] Starting benchmark")
-    log(f"[INFO] PDFs: {args.pdf}")
-    log(f"[INFO] Models: {args.models}")
-    log(f"{'='*60}\n")
-
-    # Extract PDFs
-    pdf_texts: Dict[Path, Dict[str, str]] = {}
-    for p in args.pdf:
-        pdf = Path(p)
-        if not pdf.exists():
-            log(f"[WARN] Missing: {pdf}")
-            continue
-        
-        try:
-            log(f"[INFO] Extracting: {pdf.name}")
-            raw = extract_text_by_page(str(pdf))
-            log(f"[INFO] Total text length: {len(raw)} characters")
-            
-            # Try to split into sections
-            sections = split_into_sections(raw)
-            
-            # Log what we found
-            log(f"[INFO] Sections detected: {list(sections.keys())}")
-            for name, text in sections.items():
-                log(f"  - {name}: {len(text)} chars")
-            
-            # Only keep sections with substantial content
-            valid_sections = {}
-            for name, text in sections.items():
-                if len(text) > 300:  # Need at least 300 chars for meaningful content
-                    valid_sections[name] = text
-                else:
-                    log(f"  - Skipping {name} (too short: {len(text)} chars)")
-            
-            if not valid_sections:
-                log(f"[WARN] No valid sections found, skipping PDF")
+        log_fh.write(msg + "\n")
+
+    try:
+        log(f"\n{'='*60}")
+        log(f"[INFO] Starting benchmark")
+        log(f"[INFO] PDFs: {args.pdf}")
+        log(f"[INFO] Models: {args.models}")
+        log(f"[INFO] Strategy: {strategy.name}")
+        log(f"{'='*60}\n")
+
+        # Extract PDFs, one worker process per PDF up to the core count
+        pdf_texts: Dict[Path, object] = {}
+        pdfs: List[Path] = []
+        for p in args.pdf:
+            pdf = Path(p)
+            if not pdf.exists():
+                log(f"[WARN] Missing: {pdf}")
                 continue
-            
-            pdf_texts[pdf] = valid_sections
-            log(f"[OK] Using {len(valid_sections)} sections: {list(valid_sections.keys())}\n")
-            
-        except Exception as e:
-            log(f"[ERROR] {pdf.name}: {e}")
-            traceback.print_exc()
+            pdfs.append(pdf)
 
-    if not pdf_texts:
-        log("[FATAL] No PDFs processed")
-        return
+        if not pdfs:
+            log("[FATAL] No PDFs processed")
+            return
 
-    # Load models
-    models: Dict[str, Tuple] = {}
-    for mid in args.models:
-        try:
-            log(f"[INFO] Loading {mid}")
-            t0 = time.time()
-            tok, model = load_model(mid, use_fast=False)
-            model.to(DEVICE)
-            models[mid] = (tok, model)
-            log(f"[OK] Loaded {mid} in {time.time()-t0:.1f}s\n")
-        except Exception as e:
-            log(f"[ERROR] Failed to load {mid}: {e}\n")
-            traceback.print_exc()
-
-    if not models:
-        log("[FATAL] No models loaded")
-        return
-
-    # Build report
-    report_lines = [
-        "# Scientific Paper Summarization Benchmark",
-        f"- Models: {', '.join(models.keys())}",
-        f"- Settings: max_in={args.max_in_tokens}, max_out={args.max_out_tokens}, beams={args.num_beams}",
-        ""
-    ]
-
-    # Process each PDF with each model
-    for pdf, sections in pdf_texts.items():
-        report_lines.append(f"## {pdf.stem}")
-        report_lines.append(f"_Source_: `{pdf.name}`")
-        report_lines.append(f"_Sections found_: {', '.join(sections.keys())}\n")
-
-        for mid, (tok, model) in models.items():
-            log(f"[RUN] {pdf.stem} × {mid}")
-            log(f"{'='*40}")
-            t0 = time.time()
-            
-            parts = []
-            section_order = ["abstract", "introduction", "methods", "results", "discussion", "conclusion"]
-            
-            for section_name in section_order:
-                if section_name not in sections:
-                    continue
-                
-                section_text = sections[section_name]
-                prompt = SECTION_PROMPTS.get(section_name, SECTION_PROMPTS["abstract"])
-                
-                log(f"  [{section_name}] Processing {len(section_text)} chars...")
-                
-                try:
-                    summary = summarize_with_model(
-                        tok, model,
-                        prompt + section_text,
-                        args.max_in_tokens,
-                        args.max_out_tokens,
-                        args.num_beams
-                    )
-                    summary = clean_summary(summary)
-                    
-                    if summary != "not reported":
-                        parts.append(f"**{section_name.title()}**: {summary}")
-                        log(f"  [{section_name}] ✓ Generated {len(summary)} chars")
-                    else:
-                        log(f"  [{section_name}] ⚠ Summary too short or invalid")
-                    
-                except Exception as e:
-                    log(f"  [{section_name}] ✗ Error: {e}")
-                    parts.append(f"**{section_name.title()}**: [Error: {e}]")
-            
-            if not parts:
-                parts.append("**Note**: No valid summaries generated for this model.")
-            
-            combined = "\n\n".join(parts)
-            elapsed = time.time() - t0
-            log(f"[OK] Completed in {elapsed:.1f}s")
-            log(f"{'='*40}\n")
-            
-            # Save individual output
-            out_file = outdir / f"{sanitize(pdf.stem)}__{sanitize(mid)}.txt"
-            out_file.write_text(combined, encoding="utf-8")
-            
-            # Add to report
-            report_lines.append(f"### {mid}")
-            report_lines.append("```")
-            report_lines.append(combined)
-            report_lines.append("```\n")
-
-    # Write report
-    report_path = outdir / "benchmark_report.md"
-    report_path.write_text("\n".join(report_lines), encoding="utf-8")
-    log(f"\n{'='*60}")
-    log(f"[SUCCESS] Report saved: {report_path}")
-    log(f"[SUCCESS] Individual files in: {outdir.resolve()}")
-    log(f"{'='*60}")
+        # A producer thread drives the process pool so extraction overlaps
+        # loading the first model and summarizing the PDFs that are ready.
+        # Unbounded: every document is kept for the later models anyway.
+        ready: "queue.Queue" = queue.Queue()
+
+        def extract_worker():
+            try:
+                workers = min(len(pdfs), os.cpu_count() or 1)
+                # spawn: forking from a non-main thread of a process that may
+                # already hold torch/tokenizer threads can deadlock the child
+                with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as ex:
+                    for pdf, result in zip(pdfs, ex.map(partial(prepare_pdf, strategy), pdfs)):
+                        ready.put((pdf, result))
+            except Exception as e:
+                ready.put((None, (None, [], (str(e), traceback.format_exc()))))
+            finally:
+                ready.put(None)
+
+        def extracted():
+            """Yield (pdf, doc) as the producer finishes them, recording them in pdf_texts."""
+            while (item := ready.get()) is not None:
+                pdf, (doc, notes, err) = item
+                name = pdf.name if pdf is not None else "extraction"
+                log(f"[INFO] Extracted: {name}")
+                for note in notes:
+                    log(note)
+                if err is not None:
+                    log(f"[ERROR] {name}: {err[0]}")
+                    print(err[1], file=sys.stderr)
+                elif doc is not None:
+                    pdf_texts[pdf] = doc
+                    yield pdf, doc
+
+        producer = threading.Thread(target=extract_worker, name="pdf-extract", daemon=True)
+        producer.start()
+        extraction_done = False
+
+        import torch
+        DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+        # Load, run and release one model at a time so only one is resident
+        results: Dict[Tuple[Path, str], Path] = {}
+        loaded: List[str] = []
+        for mid in args.models:
+            try:
+                log(f"[INFO] Loading {mid}")
+                t0 = time.time()
+                tok, model = load_model(mid, use_fast=False, compile=args.compile,
+                                        jit=args.jit, device=DEVICE,
+                                        quantize=args.quantize, autocast=args.bf16_autocast)
+                log(f"[OK] Loaded {mid} in {time.time()-t0:.1f}s\n")
+            except Exception as e:
+                log(f"[ERROR] Failed to load {mid}: {e}\n")
+                traceback.print_exc()
+                continue
+            loaded.append(mid)
+            strategy.begin_model(tok)
+
+            # The first model to load consumes PDFs as they are extracted
+            docs = list(pdf_texts.items()) if extraction_done else extracted()
+            for pdf, doc in docs:
+                log(f"[RUN] {pdf.stem} × {mid}")
+                log(f"{'='*40}")
+                t0 = time.time()
+                combined = strategy.summarize(tok, model, doc, args, log)
+                log(f"[OK] Completed in {time.time() - t0:.1f}s")
+                log(f"{'='*40}\n")
+
+                # Save individual output; the report reads it back later
+                out_file = outdir / f"{sanitize(pdf.stem)}__{sanitize(mid)}.txt"
+                out_file.write_text(combined, encoding="utf-8")
+                results[(pdf, mid)] = out_file
+
+            extraction_done = True
+
+            # Release weights before the next model is loaded
+            strategy.end_model()
+            del tok, model
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+        if not extraction_done:
+            # Every model failed to load; still report what extraction did
+            for _ in extracted():
+                pass
+        producer.join()
+
+        if not pdf_texts:
+            log("[FATAL] No PDFs processed")
+            return
+        if not loaded:
+            log("[FATAL] No models loaded")
+            return
+
+        # Write report, streaming each summary file straight into it
+        report_path = outdir / "benchmark_report.md"
+        with open(report_path, "w", encoding="utf-8", buffering=1 << 16) as report_fh:
+            def write(line: str):
+                report_fh.write(line + "\n")
+
+            write("# Scientific Paper Summarization Benchmark")
+            write(f"- Models: {', '.join(loaded)}")
+            write(f"- Settings: strategy={strategy.name}, max_in={args.max_in_tokens}, max_out={args.max_out_tokens}, beams={args.num_beams}")
+            write("")
+            for pdf, doc in pdf_texts.items():
+                write(f"## {pdf.stem}")
+                write(f"_Source_: `{pdf.name}`")
+                write(strategy.describe(doc))
+
+                for mid in loaded:
+                    write(f"### {mid}")
+                    write("```")
+                    with open(results[(pdf, mid)], encoding="utf-8") as src:
+                        shutil.copyfileobj(src, report_fh)
+                    write("")
+                    write("```\n")
+
+        log(f"\n{'='*60}")
+        log(f"[SUCCESS] Report saved: {report_path}")
+        log(f"[SUCCESS] Individual files in: {outdir.resolve()}")
+        log(f"{'='*60}")
+    finally:
+        log_fh.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -4,13 +4,14 @@ import sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from app.pdf_io import extract_text_by_page
-from app.sections import split_into_sections
-
 if len(sys.argv) < 2:
     print("Usage: python check_sections.py <pdf_path>")
     sys.exit(1)
 
+# Imported after the usage check so a bare invocation returns immediately
+from app.pdf_io import extract_text_by_page
+from app.sections import split_into_sections
+
 pdf_path = sys.argv[1]
 print(f"\nAnalyzing: {pdf_path}\n")
 
@@ -5,11 +5,20 @@ Shared helpers for IttyBitty scripts:
 - PDF processing
 """
 from __future__ import annotations
+from contextlib import ExitStack
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List
+from typing import TYPE_CHECKING, Dict, List
+import os
 import re
-import torch
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+
+# Let the Rust tokenizers use their thread pool (and skip the fork warning)
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+
+# torch/transformers are imported inside the functions that need them so
+# scripts can parse arguments and extract PDFs without paying for them.
+if TYPE_CHECKING:
+    import torch
 
 # Reuse app utilities
 from app.pdf_io import extract_text_by_page
@@ -24,31 +33,182 @@ DEFAULT_MODELS = [
 ]
 
 
+QUANTIZE_MODES = ("none", "int8", "bf16")
+
 STRUCTURE_PROMPT = (
     "Summarize the following scientific content into a structured abstract with these fields:\n"
     "- Background:\n- Methods:\n- Results:\n- Conclusions:\n"
     "Be concise and strictly use facts from the text.\nTEXT:\n"
 )
 
+_SANITIZE_RE = re.compile(r"[^a-zA-Z0-9._-]+")
+
 def sanitize(name: str) -> str:
-    return re.sub(r"[^a-zA-Z0-9._-]+", "_", name)
+    return _SANITIZE_RE.sub("_", name)
+
+
+@lru_cache(maxsize=None)
+def load_tokenizer(model_id: str, use_fast: bool = True):
+    """Tokenizers are small, so keep them for the life of the process."""
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(model_id, use_fast=use_fast)
+
 
+def load_model(model_id: str, use_fast: bool = True, compile: bool = False, jit: bool = False,
+               device=None, quantize: str = "none", autocast: bool = False):
+    """Load tokenizer and model once for a given model_id.
 
-def load_model(model_id: str, use_fast: bool = True):
-    """Load tokenizer and model once for a given model_id."""
-    tok = AutoTokenizer.from_pretrained(model_id, use_fast=use_fast)
-    model = AutoModelForSeq2SeqLM.from_pretrained(model_id)
+    The model itself is not cached so callers can release it between runs.
+    Pass compile=True to run the forward pass through torch.compile,
+    jit=True to swap in a TorchScript-traced encoder, and autocast=True to
+    run generation under bf16 autocast on GPUs that support it (fp32 is
+    the default). The model is moved to `device` first so
+    tracing happens on the device it will run on.
+
+    quantize is one of QUANTIZE_MODES: "int8" loads through bitsandbytes
+    (placed by device_map="auto", so `device` is ignored), "bf16" loads
+    bfloat16 weights.
+    """
+    if quantize not in QUANTIZE_MODES:
+        raise ValueError(f"quantize must be one of {QUANTIZE_MODES}, got {quantize!r}")
+    import torch
+    from transformers import AutoModelForSeq2SeqLM
+
+    tok = load_tokenizer(model_id, use_fast)
+    kwargs = {}
+    if quantize == "int8":
+        from transformers import BitsAndBytesConfig
+        kwargs.update(quantization_config=BitsAndBytesConfig(load_in_8bit=True), device_map="auto")
+        device = None  # 8-bit models cannot be moved with .to()
+    elif quantize == "bf16":
+        kwargs["torch_dtype"] = torch.bfloat16
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_id, **kwargs)
     model.eval()
+    # Read by generation_context (set before tracing, which runs under it)
+    model._ib_autocast = autocast
+    # Some configs (e.g. LED) ship with the decoder KV cache turned off
+    model.config.use_cache = True
+    model.generation_config.use_cache = True
+    if device is not None:
+        model.to(device)
+    if jit:
+        _trace_encoder(tok, model)
+    if compile:
+        compile_model(model)
+    # Looked up once here instead of on every summarize call
+    model._ib_device = next(model.parameters()).device
     return tok, model
 
+def compile_model(model) -> None:
+    """Run model's forward pass through torch.compile, in place."""
+    import torch
+    # Compile forward rather than the module so model.generate() uses it
+    model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+    # A pre-allocated KV cache keeps decode shapes fixed, so the compiled
+    # graph is not re-specialized as the sequence grows. Only newer
+    # transformers releases support it, and only for some architectures.
+    if getattr(model, "_supports_static_cache", False):
+        model.generation_config.cache_implementation = "static"
+
+def to_device(enc, device):
+    """Move a dict of CPU tensors to device; pinned and non-blocking for CUDA."""
+    if device.type != "cuda":
+        return {k: v.to(device) for k, v in enc.items()}
+    return {k: v.pin_memory().to(device, non_blocking=True) for k, v in enc.items()}
+
+def _trace_encoder(tok, model) -> bool:
+    """Replace model.get_encoder() with a traced copy; keep eager on any failure."""
+    import torch
+    from transformers.modeling_outputs import BaseModelOutput
+
+    encoder = model.get_encoder()
+    device = model.device
+    max_len = min(1024, getattr(model.config, "max_position_embeddings", 1024))
+
+    class _EncoderFn(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.encoder = encoder
+
+        def forward(self, input_ids, attention_mask):
+            return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+    def example(batch: int, length: int):
+        enc = tok(["warm up " * length] * batch, return_tensors="pt", truncation=True, max_length=length)
+        return enc["input_ids"].to(device), enc["attention_mask"].to(device)
+
+    try:
+        with torch.no_grad():
+            traced = torch.jit.trace(_EncoderFn().eval(), example(1, max_len), strict=False, check_trace=False)
+            # Shapes can get baked in while tracing; make sure another one still matches eager
+            ids, mask = example(2, max_len // 2)
+            ref = encoder(input_ids=ids, attention_mask=mask, return_dict=False)[0]
+            if not torch.allclose(traced(ids, mask), ref, atol=1e-4):
+                return False
+    except Exception:
+        return False
+
+    class _TracedEncoder(torch.nn.Module):
+        main_input_name = encoder.main_input_name
+
+        def __init__(self):
+            super().__init__()
+            self.traced = traced
+
+        def forward(self, input_ids=None, attention_mask=None, **kwargs):
+            return BaseModelOutput(last_hidden_state=self.traced(input_ids, attention_mask))
+
+    traced_encoder = _TracedEncoder()
+    model.get_encoder = lambda: traced_encoder
+
+    # One representative generate call to trigger the TorchScript profiling runs
+    try:
+        ids, mask = example(1, max_len)
+        with generation_context(model):
+            model.generate(input_ids=ids, attention_mask=mask, max_new_tokens=4, num_beams=1)
+    except Exception:
+        del model.get_encoder  # back to the class method, i.e. eager
+        return False
+    return True
+
+def generation_context(model):
+    """inference_mode, plus bf16 autocast if load_model(autocast=True) asked
+    for it and the GPU supports it."""
+    import torch
+    stack = ExitStack()
+    stack.enter_context(torch.inference_mode())
+    if (getattr(model, "_ib_autocast", False) and model.device.type == "cuda"
+            and torch.cuda.is_bf16_supported()):
+        stack.enter_context(torch.autocast(device_type="cuda", dtype=torch.bfloat16))
+    return stack
+
 def _chunk_token_ids(ids, max_len: int):
     for i in range(0, len(ids), max_len):
         yield ids[i:i+max_len]
 
+def precompute_ids(tok, text: str) -> List[int]:
+    """Untruncated token ids for text (no special tokens)."""
+    return tok(text, add_special_tokens=False, truncation=False)["input_ids"]
+
+@lru_cache(maxsize=8)
+def _structure_prompt_ids(tok) -> List[int]:
+    return tok(STRUCTURE_PROMPT, add_special_tokens=False)["input_ids"]
+
 def summarize_text_with(tok, model, text: str, structured=True,
-                   max_in_tokens=1024, max_out_tokens=256, num_beams=4) -> str:
-    if structured:
-        text = STRUCTURE_PROMPT + text
+                   max_in_tokens=1024, max_out_tokens=256, num_beams=4, chunk_beams=1) -> str:
+    # Get length WITHOUT truncation so we can decide the path
+    ids = precompute_ids(tok, text)
+    return summarize_with_ids(tok, model, ids, structured=structured, max_in_tokens=max_in_tokens,
+                              max_out_tokens=max_out_tokens, num_beams=num_beams, chunk_beams=chunk_beams)
+
+def summarize_with_ids(tok, model, ids: List[int], structured=True,
+                       max_in_tokens=1024, max_out_tokens=256, num_beams=4, chunk_beams=1) -> str:
+    """Same as summarize_text_with, for ids from precompute_ids().
+
+    With structured=True the STRUCTURE_PROMPT ids are put in front of the
+    text (or of every chunk of it) without re-tokenizing anything.
+    """
+    import torch
 
     # Cap by model’s position embedding limit if present (e.g., BART≈1024)
     safe_max = min(
@@ -56,14 +216,20 @@ def summarize_text_with(tok, model, text: str, structured=True,
         getattr(getattr(model, "config", None), "max_position_embeddings", max_in_tokens)
     )
     tok.model_max_length = safe_max
-    # Get length WITHOUT truncation so we can decide the path
-    ids = tok(text, return_tensors="pt", truncation=False).input_ids[0]
+    device = getattr(model, "_ib_device", None) or next(model.parameters()).device
+    prompt_ids = _structure_prompt_ids(tok) if structured else []
+    # Text tokens that fit next to the prompt and the special tokens
+    room = safe_max - len(prompt_ids) - tok.num_special_tokens_to_add()
+    if room <= 0:
+        raise ValueError(f"an input limit of {safe_max} tokens leaves no room for text after "
+                         f"the prompt ({len(prompt_ids)} tokens) and special tokens")
 
-    # --- Short path
-    if len(ids) <= safe_max:
-        enc = tok(text, return_tensors="pt", truncation=True, max_length=safe_max)
-        enc = {k: v.to(next(model.parameters()).device) for k, v in enc.items()}
-        with torch.no_grad():
+    # --- Short path: the ids above already fit, so reuse them as-is
+    if len(ids) <= room:
+        input_ids = torch.tensor([tok.build_inputs_with_special_tokens(prompt_ids + ids)])
+        enc = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+        enc = to_device(enc, device)
+        with generation_context(model):
             out = model.generate(
                 **enc,
                 max_new_tokens=max_out_tokens,
@@ -78,31 +244,37 @@ def summarize_text_with(tok, model, text: str, structured=True,
         out_text = out_text.replace(" <n> ", "\n").replace("<n>", "\n")
         return _dedupe_lines(out_text)
 
-    # --- Hierarchical path
-    parts: List[str] = []
-    for piece in _chunk(ids, safe_max):
-        chunk_text = tok.decode(piece, skip_special_tokens=True)  # no max_length arg here
-        if structured:
-            chunk_text = STRUCTURE_PROMPT + chunk_text
-        enc = tok(chunk_text, return_tensors="pt", truncation=True, max_length=safe_max)
-        enc = {k: v.to(next(model.parameters()).device) for k, v in enc.items()}
-        with torch.no_grad():
-            out = model.generate(
-                **enc,
-                max_new_tokens=max_out_tokens,
-                num_beams=max(num_beams, 5),
-                do_sample=False,
-                length_penalty=1.1,
-                early_stopping=True,
-                no_repeat_ngram_size=3,
-                repetition_penalty=1.15,
-            )
-        parts.append(tok.decode(out[0], skip_special_tokens=True))
+    # --- Hierarchical path: all chunks in one padded generate call.
+    # Chunks are decoded greedily by default; beams go to the final merge.
+    chunks = [tok.build_inputs_with_special_tokens(prompt_ids + piece) for piece in _chunk(ids, room, _sentence_break_ids(tok))]
+    # Length-sorted so neighbouring rows pad to similar lengths
+    order = sorted(range(len(chunks)), key=lambda i: len(chunks[i]))
+    enc = tok.pad({"input_ids": [chunks[i] for i in order]}, return_tensors="pt")
+    enc = to_device(enc, device)
+    with generation_context(model):
+        out = model.generate(
+            **enc,
+            max_new_tokens=max_out_tokens,
+            num_beams=chunk_beams,
+            do_sample=False,
+            # beam-only options; passing them to greedy search just warns
+            **({"length_penalty": 1.1, "early_stopping": True} if chunk_beams > 1 else {}),
+            no_repeat_ngram_size=3,
+            repetition_penalty=1.15,
+        )
+    parts: List[str] = [""] * len(chunks)
+    for i, part in zip(order, tok.batch_decode(out, skip_special_tokens=True)):
+        parts[i] = part
 
     combined = "\n".join(parts)
     enc = tok(combined, return_tensors="pt", truncation=True, max_length=safe_max)
-    enc = {k: v.to(next(model.parameters()).device) for k, v in enc.items()}
-    with torch.no_grad():
+    # Unstructured greedy runs keep the chunk summaries as they are when they
+    # already fit in one window; the merge pass only refines, which is worth a
+    # generate call when beams were asked for
+    if not structured and num_beams <= 1 and enc["input_ids"].shape[1] < safe_max:
+        return _dedupe_lines(combined.replace(" <n> ", "\n").replace("<n>", "\n"))
+    enc = to_device(enc, device)
+    with generation_context(model):
         out = model.generate(
             **enc,
             max_new_tokens=max_out_tokens,
@@ -119,16 +291,38 @@ def summarize_text_with(tok, model, text: str, structured=True,
     return _dedupe_lines(final_text)
 
 def _dedupe_lines(s: str) -> str:
-    seen = set(); out = []
-    for line in [x.strip() for x in s.splitlines() if x.strip()]:
-        k = line.lower()
-        if k not in seen:
-            seen.add(k); out.append(line)
-    return "\n".join(out)
-
-def _chunk(ids, max_len: int):
-    for i in range(0, len(ids), max_len):
-        yield ids[i:i+max_len]
+    # Keyed on the lowercased line; setdefault keeps the first spelling and order
+    seen: Dict[str, str] = {}
+    for line in (x.strip() for x in s.splitlines()):
+        if line:
+            seen.setdefault(line.lower(), line)
+    return "\n".join(seen.values())
+
+def _chunk(ids, max_len: int, break_ids=frozenset()):
+    """Slices of at most max_len ids, cut after the last sentence break in
+    the back half of each window (hard cut at max_len if there is none)."""
+    if max_len <= 0:
+        raise ValueError(f"max_len must be positive, got {max_len}")
+    start, n = 0, len(ids)
+    while start < n:
+        end = min(start + max_len, n)
+        if end < n and break_ids:
+            for j in range(end - 1, start + max_len // 2 - 1, -1):
+                if ids[j] in break_ids:
+                    end = j + 1
+                    break
+        yield ids[start:end]
+        start = end
+
+@lru_cache(maxsize=8)
+def _sentence_break_ids(tok) -> frozenset:
+    """Ids of the tokens that end a sentence or line for this tokenizer."""
+    # "." for BPE and SentencePiece, "▁." for SentencePiece, "Ċ" is the BPE
+    # newline and "<n>" is Pegasus' newline
+    ids = {tok.convert_tokens_to_ids(t) for t in (".", "▁.", "Ċ", "<n>")}
+    ids.discard(None)
+    ids.discard(tok.unk_token_id)
+    return frozenset(ids)
 
 def process_pdf(pdf_path: Path, max_sections: int = 5) -> str:
     raw = extract_text_by_page(str(pdf_path))
@@ -6,19 +6,21 @@ Pass 1: Extract structured facts
 Pass 2: Generate readable summary using facts
 Pass 3: Quality check and format
 """
+from collections import Counter
 from pathlib import Path
+import hashlib
+import os
+import pickle
 import sys
 import re
-from typing import Dict, List
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from app.pdf_io import extract_text_by_page
 from app.sections import split_into_sections
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM, pipeline
-import torch
-
-DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+from scripts.common import compile_model
 
 # Pass 1: Extract specific information
 EXTRACTION_PROMPTS = {
@@ -58,215 +60,398 @@ EXTRACTION_PROMPTS = {
     }
 }
 
+# Facts that cannot be answered from a section with no numbers in it
+_NEEDS_NUMBERS = {"statistics", "primary_finding"}
+
+# Pattern for: N=24, M=45.2, SD=8.1, p<.01, t(48)=3.2, d=0.78
+_NUMBER_PATTERNS = [
+    r'[NnMm]\s*=\s*[\d.]+',
+    r'SD\s*=\s*[\d.]+',
+    r'[pt]\s*[<>=]\s*\.?\d+',
+    r't\(\d+\)\s*=\s*[\d.]+',
+    r'd\s*=\s*[\d.]+',
+    r'r\s*=\s*[\d.]+',
+    r'F\(\d+,\s*\d+\)\s*=\s*[\d.]+',
+    r'\d+%',
+    r'\d+\s*participants?',
+    r'\d+\s*subjects?',
+]
+# Matches of different patterns overlap ("N=24" and "24 participants"), so
+# extraction runs each pattern on its own; the alternation is only used to
+# test whether a text contains any of them
+_NUMBER_RES = [re.compile(p, re.IGNORECASE) for p in _NUMBER_PATTERNS]
+_NUMBER_RE = re.compile("|".join(f"(?:{p})" for p in _NUMBER_PATTERNS), re.IGNORECASE)
+
+# Pattern for: (Author, Year) or Author et al. (Year)
+_CITATION_PATTERNS = [
+    r'[A-Z][a-z]+(?:\s+et al\.)?\s*\(\d{4}\)',
+    r'\([A-Z][a-z]+(?:\s+et al\.)?,?\s*\d{4}\)',
+]
+_CITATION_RES = [re.compile(p) for p in _CITATION_PATTERNS]
+
+def _scan(chunks: List[str], patterns) -> Iterator[str]:
+    """Every match of every pattern, one finditer per pattern so overlaps survive."""
+    return (m.group(0) for pat in patterns for chunk in chunks for m in pat.finditer(chunk))
+
 def extract_numbers(text: str) -> List[str]:
     """Extract all numbers with context from text."""
-    # Pattern for: N=24, M=45.2, SD=8.1, p<.01, t(48)=3.2, d=0.78
-    patterns = [
-        r'[NnMm]\s*=\s*[\d.]+',
-        r'SD\s*=\s*[\d.]+',
-        r'[pt]\s*[<>=]\s*\.?\d+',
-        r't\(\d+\)\s*=\s*[\d.]+',
-        r'd\s*=\s*[\d.]+',
-        r'r\s*=\s*[\d.]+',
-        r'F\(\d+,\s*\d+\)\s*=\s*[\d.]+',
-        r'\d+%',
-        r'\d+\s*participants?',
-        r'\d+\s*subjects?',
-    ]
-    
-    found = []
-    for pattern in patterns:
-        matches = re.findall(pattern, text, re.IGNORECASE)
-        found.extend(matches)
-    
-    return list(set(found))
+    # Order-preserving dedupe
+    return list(dict.fromkeys(_scan(list(_candidate_windows(text)), _NUMBER_RES)))
 
 def extract_citations(text: str) -> List[str]:
     """Extract key citations from text."""
-    # Pattern for: (Author, Year) or Author et al. (Year)
-    patterns = [
-        r'[A-Z][a-z]+(?:\s+et al\.)?\s*\(\d{4}\)',
-        r'\([A-Z][a-z]+(?:\s+et al\.)?,?\s*\d{4}\)',
-    ]
-    
-    found = []
-    for pattern in patterns:
-        matches = re.findall(pattern, text)
-        found.extend(matches)
-    
     # Return most frequent (key citations)
-    from collections import Counter
-    counts = Counter(found)
+    counts = Counter(_scan(list(_candidate_windows(text)), _CITATION_RES))
     return [cite for cite, count in counts.most_common(5)]
 
-def extract_fact(text: str, question: str, tokenizer, model) -> str:
-    """Extract a specific fact from text using targeted question."""
-    prompt = f"{question}\n\nAnswer in 1-2 specific sentences using ONLY information from the text below. Include numbers, names, and technical terms.\n\nTEXT:\n{text[:2000]}"
+# Every number and citation pattern contains a digit, so on long texts the
+# regex only needs to run near digit runs. Each run gets _WINDOW_PAD chars of
+# context, widened to whole words; what is left of a match outside the digits
+# is a few fixed tokens (" et al. (", "F(", "SD =") plus whitespace, which
+# extract_text_by_page has already collapsed to single spaces.
+_WINDOW_PAD = 48
+_PREFILTER_MIN_CHARS = 20_000
+
+_text_windows = None  # scripts._digit_scan.text_windows, or False without numba
+
+def _candidate_windows(text: str) -> Iterator[str]:
+    """Slices of text that can hold a number or citation match."""
+    global _text_windows
+    if len(text) < _PREFILTER_MIN_CHARS:
+        yield text
+        return
+    if _text_windows is None:
+        try:
+            from scripts._digit_scan import text_windows as _text_windows
+        except ImportError:
+            _text_windows = False
+    if not _text_windows:
+        yield text
+        return
+    for start, end in _text_windows(text, _WINDOW_PAD):
+        yield text[start:end]
+
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?])\s+')
+_KEYWORD_RE = re.compile(r'[a-z]{4,}')
+
+def _salient_window(sent_ids: List[List[int]], sent_lower: List[str], question: str, budget: int) -> List[int]:
+    """Pack the sentences sharing the most keywords with question into budget tokens.
+
+    Chosen sentences keep their original order. A sentence that could never fit
+    on its own (tables, figure text, a section with no sentence breaks) is cut
+    to the room left rather than dropped, so the window is never empty.
+    """
+    keywords = set(_KEYWORD_RE.findall(question.lower()))
+    scores = [sum(word in sent for word in keywords) for sent in sent_lower]
     
-    enc = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=1024)
-    enc = {k: v.to(DEVICE) for k, v in enc.items()}
+    chosen, used = {}, 0
+    for i in sorted(range(len(sent_ids)), key=lambda i: (-scores[i], i)):
+        ids = sent_ids[i]
+        if len(ids) > budget:
+            ids = ids[:budget - used]
+        if ids and used + len(ids) <= budget:
+            chosen[i] = ids
+            used += len(ids)
     
-    with torch.no_grad():
+    return [tok_id for i in sorted(chosen) for tok_id in chosen[i]]
+
+def extract_all(text: str) -> Tuple[List[str], List[str]]:
+    """extract_numbers and extract_citations over one set of candidate windows."""
+    chunks = list(_candidate_windows(text))
+    nums = list(dict.fromkeys(_scan(chunks, _NUMBER_RES)))
+    cites = Counter(_scan(chunks, _CITATION_RES))
+    return nums, [cite for cite, count in cites.most_common(5)]
+
+def extract_facts_batch(text: str, questions: List[str], tokenizer, model) -> List[str]:
+    """Answer several targeted questions about the same text in one batched pass."""
+    import torch
+    
+    # Tokenize the section's sentences once; each question then gets its own
+    # window of the most relevant ones instead of a fixed character prefix
+    suffix = "\n\nAnswer in 1-2 specific sentences using ONLY information from the text below. Include numbers, names, and technical terms.\n\nTEXT:\n"
+    sentences = _SENTENCE_SPLIT_RE.split(text)
+    sent_ids = tokenizer([" " + sent for sent in sentences], add_special_tokens=False).input_ids
+    sent_lower = [sent.lower() for sent in sentences]
+    head_ids = tokenizer([q + suffix for q in questions], add_special_tokens=False).input_ids
+    
+    room = tokenizer.model_max_length - tokenizer.num_special_tokens_to_add()
+    features = []
+    for question, head in zip(questions, head_ids):
+        budget = min(900, room - len(head))
+        window = _salient_window(sent_ids, sent_lower, question, budget)
+        features.append({"input_ids": tokenizer.build_inputs_with_special_tokens(head + window)})
+    enc = tokenizer.pad(features, return_tensors="pt").to(model.device)
+    
+    with torch.inference_mode():
         out = model.generate(
             **enc,
+            use_cache=True,
             max_new_tokens=150,
             num_beams=4,
-            temperature=0.3,
-            do_sample=True,
-            top_p=0.9,
+            do_sample=False,
+            early_stopping=True,
+            length_penalty=1.0,
+            no_repeat_ngram_size=3,
         )
     
-    answer = tokenizer.decode(out[0], skip_special_tokens=True)
-    return answer.strip()
+    answers = tokenizer.batch_decode(out, skip_special_tokens=True)
+    return [answer.strip() for answer in answers]
+
+def load_model(compile: bool = False, bettertransformer: bool = False):
+    """Load the extraction tokenizer and model once; returns (tokenizer, model).
 
-def summarize_paper_detailed(pdf_path: str) -> Dict:
-    """Generate detailed, information-dense summary."""
+    bettertransformer=True swaps in fused attention via optimum's
+    BetterTransformer (optimum must be installed); compile=True runs the
+    forward pass through torch.compile, as in benchmark.py.
+    """
+    print("Loading model...")
+    import torch
+    from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+    
+    DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    MODEL_ID = "facebook/bart-large-cnn"
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_ID, use_fast=True)
+    if not tokenizer.is_fast:
+        raise RuntimeError(f"{MODEL_ID} has no fast (Rust) tokenizer; install the tokenizers package")
+    tokenizer.model_max_length = 1024
+    if DEVICE.type == "cuda":
+        torch.set_float32_matmul_precision("high")
+    
+    # Half-precision weights on GPU: bf16 where supported, else fp16
+    if DEVICE.type == "cuda":
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    else:
+        dtype = torch.float32
+    model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_ID, torch_dtype=dtype)
+    model.to(DEVICE)
+    model.eval()
+    if bettertransformer:
+        from optimum.bettertransformer import BetterTransformer
+        model = BetterTransformer.transform(model)
+        print("  attention: BetterTransformer")
+    if compile:
+        compile_model(model)
+        print("  forward: torch.compile")
+    print("✓ Model loaded\n")
+    return tokenizer, model
+
+CACHE_DIR = Path.home() / ".cache" / "ittybitty"
+
+def load_sections(pdf_path: str, cache_sections: bool = True) -> Dict[str, str]:
+    """Extract and split a PDF, memoized on disk by path, mtime and size."""
+    stat = Path(pdf_path).stat()
+    key = f"{Path(pdf_path).resolve()}:{stat.st_mtime_ns}:{stat.st_size}"
+    cache_file = CACHE_DIR / f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.pkl"
+    
+    if cache_sections and cache_file.exists():
+        try:
+            with open(cache_file, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            pass  # unreadable or truncated entry: treat as a miss and rewrite it
+    
+    sections = split_into_sections(extract_text_by_page(pdf_path))
+    if cache_sections:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Write beside the target and rename, so an interrupted dump never
+        # leaves a truncated entry under the real name
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(sections, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache_file)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    return sections
+
+def summarize_paper_detailed(pdf_path: str, tokenizer=None, model=None, cache_sections: bool = True,
+                             sections: Optional[Dict[str, str]] = None) -> Dict:
+    """Generate detailed, information-dense summary.
+
+    Pass a (tokenizer, model) pair from load_model() to reuse it across papers;
+    otherwise one is loaded for this call. Pass sections from load_sections()
+    if the PDF has already been parsed; otherwise it is parsed here, and
+    cache_sections=False re-parses it instead of reading CACHE_DIR.
+    """
     print(f"\n{'='*60}")
     print(f"Processing: {Path(pdf_path).stem}")
     print(f"{'='*60}\n")
     
     # Extract and split
-    raw_text = extract_text_by_page(pdf_path)
-    sections = split_into_sections(raw_text)
+    if sections is None:
+        sections = load_sections(pdf_path, cache_sections=cache_sections)
     valid_sections = {name: text for name, text in sections.items() if len(text) > 200}
     
     print(f"Found sections: {list(valid_sections.keys())}\n")
     
-    # Load model
-    print("Loading model...")
-    MODEL_ID = "facebook/bart-large-cnn"
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
-    model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_ID)
-    model.to(DEVICE)
-    model.eval()
-    print("✓ Model loaded\n")
+    # Load model (heavy imports deferred until PDF parsing has succeeded)
+    if tokenizer is None or model is None:
+        tokenizer, model = load_model()
     
     # Pass 1: Extract structured facts
+    # tqdm ships with transformers, so it is only imported once that is loaded
+    from tqdm import tqdm
+    
     print("Pass 1: Extracting facts...")
     extracted = {}
     
-    for section_name, section_text in valid_sections.items():
-        if section_name not in EXTRACTION_PROMPTS:
-            continue
+    # Longest section first, so a compiled model sees the largest shape up front
+    # (format_summary lays sections out in its own fixed order)
+    order = sorted(EXTRACTION_PROMPTS.keys() & valid_sections.keys(),
+                   key=lambda name: -len(valid_sections[name]))
+    progress = tqdm(order, desc="Sections", unit="section", leave=False)
+    for section_name in progress:
+        progress.set_postfix_str(section_name)
+        section_text = valid_sections[section_name]
         
-        print(f"  [{section_name}]")
-        extracted[section_name] = {}
+        # Numeric questions are skipped outright when the section has no numbers
+        facts = dict.fromkeys(EXTRACTION_PROMPTS[section_name], "not reported")
+        extracted[section_name] = facts
+        has_stats = _NUMBER_RE.search(section_text) is not None
+        questions = {fact_name: q for fact_name, q in EXTRACTION_PROMPTS[section_name].items()
+                     if has_stats or fact_name not in _NEEDS_NUMBERS}
+        if not questions:
+            continue
         
-        questions = EXTRACTION_PROMPTS[section_name]
-        for fact_name, question in questions.items():
-            print(f"    - {fact_name}...", end=" ", flush=True)
-            try:
-                answer = extract_fact(section_text, question, tokenizer, model)
-                extracted[section_name][fact_name] = answer
-                print("✓")
-            except Exception as e:
-                print(f"✗ {e}")
-                extracted[section_name][fact_name] = "not reported"
+        # All remaining questions for this section go through one generate call
+        try:
+            answers = extract_facts_batch(section_text, list(questions.values()), tokenizer, model)
+            facts.update(zip(questions, answers))
+        except Exception as e:
+            progress.write(f"  [{section_name}] ✗ {e}")
+    
+    print(f"✓ Extracted facts from {len(order)} sections")
     
     # Pass 2: Extract numbers and citations
     print("\nPass 2: Extracting numbers and citations...")
     for section_name, section_text in valid_sections.items():
-        if section_name == "methods" or section_name == "results":
-            nums = extract_numbers(section_text)
-            if nums:
-                extracted[section_name]["key_numbers"] = nums
-                print(f"  [{section_name}] Found {len(nums)} numbers: {nums[:5]}")
+        if section_name not in ("methods", "results", "introduction"):
+            continue
+        
+        # One scan yields both numbers and citations
+        nums, cites = extract_all(section_text)
+        if section_name in ("methods", "results") and nums:
+            extracted[section_name]["key_numbers"] = nums
+            print(f"  [{section_name}] Found {len(nums)} numbers: {nums[:5]}")
         
-        if section_name == "introduction":
-            cites = extract_citations(section_text)
-            if cites:
-                extracted[section_name]["key_citations"] = cites
-                print(f"  [introduction] Key citations: {cites}")
+        if section_name == "introduction" and cites:
+            extracted[section_name]["key_citations"] = cites
+            print(f"  [introduction] Key citations: {cites}")
     
     return extracted
 
-def format_summary(extracted: Dict) -> str:
-    """Format extracted facts into readable summary."""
-    output = []
-    
+def format_summary(extracted: Dict) -> Iterator[str]:
+    """Format extracted facts into readable summary, one line at a time."""
     # Abstract/Overview
     if "abstract" in extracted:
         abs_data = extracted["abstract"]
-        output.append("## Overview\n")
-        output.append(f"**Research Question**: {abs_data.get('research_question', 'not reported')}\n")
-        output.append(f"**Approach**: {abs_data.get('approach', 'not reported')}\n")
-        output.append(f"**Main Finding**: {abs_data.get('main_finding', 'not reported')}\n")
+        yield "## Overview\n"
+        yield f"**Research Question**: {abs_data.get('research_question', 'not reported')}\n"
+        yield f"**Approach**: {abs_data.get('approach', 'not reported')}\n"
+        yield f"**Main Finding**: {abs_data.get('main_finding', 'not reported')}\n"
     
     # Introduction
     if "introduction" in extracted:
         intro = extracted["introduction"]
-        output.append("## Background\n")
-        output.append(f"**Knowledge Gap**: {intro.get('gap', 'not reported')}\n")
-        output.append(f"**Hypothesis**: {intro.get('hypothesis', 'not reported')}\n")
-        output.append(f"**Theoretical Framework**: {intro.get('theoretical_framework', 'not reported')}\n")
+        yield "## Background\n"
+        yield f"**Knowledge Gap**: {intro.get('gap', 'not reported')}\n"
+        yield f"**Hypothesis**: {intro.get('hypothesis', 'not reported')}\n"
+        yield f"**Theoretical Framework**: {intro.get('theoretical_framework', 'not reported')}\n"
         
         if "key_citations" in intro:
-            output.append(f"**Key Citations**: {', '.join(intro['key_citations'][:5])}\n")
+            yield f"**Key Citations**: {', '.join(intro['key_citations'][:5])}\n"
     
     # Methods
     if "methods" in extracted:
         meth = extracted["methods"]
-        output.append("## Methods\n")
-        output.append(f"**Participants/Sample**: {meth.get('participants', 'not reported')}\n")
-        output.append(f"**Design**: {meth.get('design', 'not reported')}\n")
-        output.append(f"**Procedure**: {meth.get('procedure', 'not reported')}\n")
-        output.append(f"**Measures**: {meth.get('measures', 'not reported')}\n")
-        output.append(f"**Analysis**: {meth.get('analysis', 'not reported')}\n")
+        yield "## Methods\n"
+        yield f"**Participants/Sample**: {meth.get('participants', 'not reported')}\n"
+        yield f"**Design**: {meth.get('design', 'not reported')}\n"
+        yield f"**Procedure**: {meth.get('procedure', 'not reported')}\n"
+        yield f"**Measures**: {meth.get('measures', 'not reported')}\n"
+        yield f"**Analysis**: {meth.get('analysis', 'not reported')}\n"
         
         if "key_numbers" in meth:
-            output.append(f"**Key Numbers**: {', '.join(meth['key_numbers'][:10])}\n")
+            yield f"**Key Numbers**: {', '.join(meth['key_numbers'][:10])}\n"
     
     # Results
     if "results" in extracted:
         res = extracted["results"]
-        output.append("## Results\n")
-        output.append(f"**Primary Finding**: {res.get('primary_finding', 'not reported')}\n")
-        output.append(f"**Statistics**: {res.get('statistics', 'not reported')}\n")
+        yield "## Results\n"
+        yield f"**Primary Finding**: {res.get('primary_finding', 'not reported')}\n"
+        yield f"**Statistics**: {res.get('statistics', 'not reported')}\n"
         
         if "key_numbers" in res:
-            output.append(f"**Key Data**: {', '.join(res['key_numbers'][:10])}\n")
+            yield f"**Key Data**: {', '.join(res['key_numbers'][:10])}\n"
         
         secondary = res.get('secondary_findings', '')
         if secondary and secondary != 'not reported':
-            output.append(f"**Secondary Findings**: {secondary}\n")
+            yield f"**Secondary Findings**: {secondary}\n"
     
     # Discussion
     if "discussion" in extracted:
         disc = extracted["discussion"]
-        output.append("## Discussion\n")
-        output.append(f"**Interpretation**: {disc.get('interpretation', 'not reported')}\n")
-        output.append(f"**Limitations**: {disc.get('limitations', 'not reported')}\n")
-        output.append(f"**Implications**: {disc.get('implications', 'not reported')}\n")
-    
-    return "\n".join(output)
+        yield "## Discussion\n"
+        yield f"**Interpretation**: {disc.get('interpretation', 'not reported')}\n"
+        yield f"**Limitations**: {disc.get('limitations', 'not reported')}\n"
+        yield f"**Implications**: {disc.get('implications', 'not reported')}\n"
 
 def main():
     import argparse
     
     ap = argparse.ArgumentParser()
-    ap.add_argument("--pdf", required=True)
+    ap.add_argument("--pdf", nargs="+", required=True)
     ap.add_argument("--output", default="detailed_summary.md")
+    ap.add_argument("--compile", action="store_true",
+                    help="Run the model forward pass through torch.compile")
+    ap.add_argument("--bettertransformer", action="store_true",
+                    help="Use optimum's BetterTransformer fused attention (requires optimum)")
+    ap.add_argument("--no-cache", action="store_true",
+                    help="Re-parse PDFs instead of reusing extracted sections from ~/.cache/ittybitty")
     args = ap.parse_args()
     
-    # Extract
-    extracted = summarize_paper_detailed(args.pdf)
+    # Parse every PDF before torch/transformers are imported, so a bad path
+    # fails fast and one unreadable paper doesn't stop the others
+    parsed, failed = [], []
+    for pdf in args.pdf:
+        try:
+            parsed.append((pdf, load_sections(pdf, cache_sections=not args.no_cache)))
+        except Exception as e:
+            print(f"✗ {pdf}: {e}")
+            failed.append(pdf)
+    if not parsed:
+        sys.exit(1)
     
-    # Format
-    print("\nFormatting summary...")
-    summary = format_summary(extracted)
+    # Load once, reuse for every paper
+    tokenizer, model = load_model(compile=args.compile, bettertransformer=args.bettertransformer)
     
-    # Add header
-    final = [
-        f"# Detailed Summary: {Path(args.pdf).stem}",
-        f"_Information-Dense Academic Summary_\n",
-        "---\n",
-        summary
-    ]
+    # Write each paper as soon as it is formatted rather than joining at the end
+    with open(args.output, "w") as f:
+        for pdf, sections in parsed:
+            try:
+                # Extract
+                extracted = summarize_paper_detailed(pdf, tokenizer, model, sections=sections)
+            except Exception as e:
+                print(f"✗ {pdf}: {e}")
+                failed.append(pdf)
+                continue
+            
+            # Format
+            print("\nFormatting summary...")
+            f.write(f"# Detailed Summary: {Path(pdf).stem}\n")
+            f.write("_Information-Dense Academic Summary_\n\n")
+            f.write("---\n\n")
+            for line in format_summary(extracted):
+                f.write(line + "\n")
+            f.flush()
     
-    # Save
-    Path(args.output).write_text("\n".join(final))
     print(f"\n✓ Saved to: {args.output}")
+    if failed:
+        print(f"✗ Failed: {', '.join(failed)}")
     print(f"{'='*60}\n")
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
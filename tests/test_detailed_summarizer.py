@@ -0,0 +1,89 @@
+import re
+
+import pytest
+
+pytest.importorskip("fitz")
+
+from scripts import detailed_summarizer as ds
+
+
+def test_extract_all_long_text_uses_numba_prefilter(monkeypatch):
+    pytest.importorskip("numba")
+    filler = "The participants completed the task without further comment. " * 400
+    text = filler + "We tested N = 24 participants (Smith, 2020). " + filler + \
+        "Jones et al. (2019) found p < .01 and 45% with M=3.2 and d = 0.78. " + filler
+    assert len(text) >= ds._PREFILTER_MIN_CHARS
+
+    nums, cites = ds.extract_all(text)
+    assert ds._text_windows  # the numba scan actually ran
+
+    monkeypatch.setattr(ds, "_PREFILTER_MIN_CHARS", len(text) + 1)
+    assert (nums, cites) == ds.extract_all(text)
+    assert "N = 24" in nums and "M=3.2" in nums
+    assert "(Smith, 2020)" in cites and "Jones et al. (2019)" in cites
+
+
+def test_salient_window_truncates_oversized_sentence():
+    assert ds._salient_window([[1] * 1200], ["participants"], "what participants", 900) == [1] * 900
+    window = ds._salient_window([[7] * 10, [1] * 1200], ["participants", "other"], "what participants", 900)
+    assert window == [7] * 10 + [1] * 890
+
+
+def test_load_sections_recovers_from_truncated_cache(monkeypatch, tmp_path):
+    calls = []
+    monkeypatch.setattr(ds, "CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setattr(ds, "extract_text_by_page", lambda path: "text")
+    monkeypatch.setattr(ds, "split_into_sections", lambda text: calls.append(text) or {"abstract": text})
+    pdf = tmp_path / "paper.pdf"
+    pdf.write_bytes(b"%PDF")
+
+    assert ds.load_sections(str(pdf)) == {"abstract": "text"}
+    (entry,) = ds.CACHE_DIR.iterdir()
+    entry.write_bytes(entry.read_bytes()[:5])
+
+    assert ds.load_sections(str(pdf)) == {"abstract": "text"}
+    assert ds.load_sections(str(pdf)) == {"abstract": "text"}
+    assert len(calls) == 2
+    assert [p.name for p in ds.CACHE_DIR.iterdir()] == [entry.name]
+
+
+BASELINE_TEXT = (
+    "We tested N=24 participants and 12 subjects. p=50% of 30 subjects responded, "
+    "t(48)=3.2, p<.01, d = 0.78, r = .45, F(1, 22) = 4.1, SD=8.1, M=45.2."
+)
+
+
+def baseline_numbers(text):
+    found = []
+    for pattern in ds._NUMBER_PATTERNS:
+        found.extend(re.findall(pattern, text, re.IGNORECASE))
+    return set(found)
+
+
+def test_extract_numbers_matches_per_pattern_baseline():
+    nums = ds.extract_numbers(BASELINE_TEXT)
+    assert len(nums) == len(set(nums))
+    assert set(nums) == baseline_numbers(BASELINE_TEXT)
+    assert {"N=24", "24 participants", "50%", "p=50"} <= set(nums)
+
+
+def test_extract_all_equals_separate_extractors():
+    text = BASELINE_TEXT + " As Smith (2020) and (Jones et al., 2019) showed, Smith (2020) holds; N=30 (Lee, 2018)."
+    assert ds.extract_all(text) == (ds.extract_numbers(text), ds.extract_citations(text))
+    assert set(ds.extract_all(text)[0]) == baseline_numbers(text)
+
+
+def test_prefilter_keeps_citation_names_longer_than_pad(monkeypatch):
+    pytest.importorskip("numba")
+    name = "Vanderlindenhoffmannschwarzeneggerbergstrom" + "a" * 20
+    cite = f"{name[0].upper()}{name[1:]} et al. (2020)"
+    assert cite.index("2020") > ds._WINDOW_PAD
+    filler = "The sample was described in the earlier work without further comment. " * 300
+    text = filler + f"As {cite} reported, 45% of 30 subjects agreed. " + filler
+    assert len(text) >= ds._PREFILTER_MIN_CHARS
+
+    nums, cites = ds.extract_all(text)
+    assert ds._text_windows
+    assert cites == [cite]
+    monkeypatch.setattr(ds, "_PREFILTER_MIN_CHARS", len(text) + 1)
+    assert (nums, cites) == ds.extract_all(text)